@@ -8,12 +8,16 @@ Usage:
 import asyncio
 import json
 import os
+import threading
 import time
+from collections import deque
+from typing import Optional
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
-from pydantic import BaseModel
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from pydantic import BaseModel, Field
 
 app = FastAPI(title="RAG Chat API")
 
@@ -31,93 +35,342 @@ BASE_DIR = os.path.dirname(__file__)
 from rag_query import (  # noqa: E402
     NOT_FOUND_MSG,
     MAX_ROUNDS,
-    TOP_K_RETRIEVE,
     TOP_K_FINAL,
     DOC_CHAR_LIMIT,
     load_store,
-    classify_query,
-    build_queries,
+    load_classifier,
+    classify_query_source,
     route_weights,
-    rrf_search_multi,
-    rerank,
     answer_or_request,
-    verify_answer,
+    check_answer,
+    VERIFY_MODE,
+    VERIFY_MODES,
     refine_query,
+    Budget,
+    budgeted_retrieve,
     parse_filters,
     parse_meta_only,
     filter_doc_ids,
-    lexical_prerank,
-    PRE_RERANK_TOP_K,
     format_meta,
     build_evidence_block,
+    embed_many,
+    log_event,
+    set_embed_batcher,
+    EMBED_MODEL,
+    EMBED_TIMEOUT,
+    gateway,
 )
+from llm_gateway import Cancelled, GatewayTimeout, request_scope  # noqa: E402
+from session_store import RetrievalSession, SessionStore  # noqa: E402
+from micro_batch import BatchedEmbedder, BatchedIndex  # noqa: E402
 
 STORE_DIR = os.environ.get("RAG_STORE_DIR", os.path.join(BASE_DIR, "rag_store"))
 index_full, index_summary, index_title, metas, bm25, bm25_title = load_store(STORE_DIR)
+load_classifier(STORE_DIR)
+
+# Optional cross-request micro-batching of embedding calls and FAISS searches.
+MICRO_BATCH = os.environ.get("RAG_MICRO_BATCH", "0") == "1"
+BATCH_WINDOW_MS = float(os.environ.get("RAG_BATCH_WINDOW_MS", "3"))
+BATCH_MAX = int(os.environ.get("RAG_BATCH_MAX", "64"))
+BATCH_IN_FLIGHT = int(os.environ.get("RAG_BATCH_IN_FLIGHT", "4"))
+if MICRO_BATCH:
+    set_embed_batcher(
+        BatchedEmbedder(
+            gateway,
+            EMBED_MODEL,
+            BATCH_WINDOW_MS,
+            BATCH_MAX,
+            timeout=EMBED_TIMEOUT,
+            max_in_flight=BATCH_IN_FLIGHT,
+        )
+    )
+    index_full, index_summary, index_title = (
+        BatchedIndex(idx, BATCH_WINDOW_MS, BATCH_MAX, max_in_flight=BATCH_IN_FLIGHT)
+        if idx is not None
+        else None
+        for idx in (index_full, index_summary, index_title)
+    )
+
 indices = {"full": index_full, "sum": index_summary, "title": index_title}
+DEFAULT_VERIFY_MODE = os.environ.get("RAG_VERIFY_MODE", VERIFY_MODE)
 
 MAX_CTX_DOCS = 24
+MAX_CONCURRENT_PIPELINES = int(os.environ.get("RAG_MAX_PIPELINES", "8"))
+MAX_QUEUE = int(os.environ.get("RAG_MAX_QUEUE", "16"))
+QUEUE_POLL_S = 1.0
+SESSION_MAX = int(os.environ.get("RAG_SESSION_MAX", "1000"))
+SESSION_MAX_BYTES = int(os.environ.get("RAG_SESSION_MAX_BYTES", str(64 * 1024 * 1024)))
+SESSION_TTL_S = float(os.environ.get("RAG_SESSION_TTL_S", "1800"))
+SESSION_POOL_SIZE = 64
+# Cosine similarity to the previous turn's query needed to reuse its pool.
+# Untuned: raise it if unrelated questions start inheriting candidates.
+SESSION_MIN_SIM = float(os.environ.get("RAG_SESSION_MIN_SIM", "0.6"))
 
 
 class ChatRequest(BaseModel):
     query: str
     conversation_id: str = ""
     relax_context: bool = False
-
-
-def _build_docs_payload(doc_ids, doc_index, score_map, sim_map):
+    docs_delta: bool = False
+    verify_mode: str = DEFAULT_VERIFY_MODE
+    deadline_s: Optional[float] = Field(default=None, gt=0)
+
+
+# Per-document render fragments. Title/link/meta/text never change for a
+# loaded store, so they are formatted once and reused across rounds and requests.
+_doc_render_cache = {}
+
+
+def _doc_render(doc_id, text=None):
+    # Collapsed passages (text given) depend on the candidate set, so only the
+    # plain per-chunk rendering is cached.
+    if text is None:
+        cached = _doc_render_cache.get(doc_id)
+        if cached is not None:
+            return cached
+    m = metas[doc_id]
+    title = m.get("title", "")
+    link = m.get("link", "")
+    meta = format_meta(m)
+    meta_line = f"\nMETA: {meta}" if meta else ""
+    body = (text if text is not None else m.get("text", ""))[:DOC_CHAR_LIMIT]
+    rendered = {
+        "ctx": f"{title}\nLINK: {link}{meta_line}\n{body}",
+        "payload": {"title": title, "link": link, "text": body, "meta": meta},
+    }
+    if text is None:
+        _doc_render_cache[doc_id] = rendered
+    return rendered
+
+
+def _score_fields(doc_id, score_map, sim_map):
+    rrf = score_map.get(doc_id)
+    sim = sim_map.get(doc_id)
+    return {
+        "rrf_score": float(rrf) if rrf is not None else None,
+        "sim_score": float(sim) if sim is not None else None,
+    }
+
+
+def _build_docs_payload(doc_ids, doc_index, score_map, sim_map, doc_texts):
     docs = []
     for doc_id in doc_ids:
-        idx = doc_index[doc_id]
-        m = metas[doc_id]
-        rrf = score_map.get(doc_id)
-        sim = sim_map.get(doc_id)
-        docs.append(
-            {
-                "index": idx,
-                "title": m.get("title", ""),
-                "link": m.get("link", ""),
-                "text": m.get("text", "")[:DOC_CHAR_LIMIT],
-                "meta": format_meta(m),
-                "rrf_score": float(rrf) if rrf is not None else None,
-                "sim_score": float(sim) if sim is not None else None,
-            }
-        )
+        doc = {"index": doc_index[doc_id]}
+        doc.update(_doc_render(doc_id, doc_texts.get(doc_id))["payload"])
+        doc.update(_score_fields(doc_id, score_map, sim_map))
+        docs.append(doc)
     return docs
 
 
-def _build_context(doc_ids, doc_index):
-    ctx = []
-    for doc_id in doc_ids:
-        idx = doc_index[doc_id]
-        m = metas[doc_id]
-        title = m.get("title", "")
-        link = m.get("link", "")
-        meta_line = format_meta(m)
-        meta_line = f"\nMETA: {meta_line}" if meta_line else ""
-        ctx.append(
-            f"[{idx}] {title}\nLINK: {link}{meta_line}\n{m.get('text','')[:DOC_CHAR_LIMIT]}"
-        )
-    return ctx
+def _build_score_updates(doc_ids, doc_index, score_map, sim_map):
+    return [
+        {"index": doc_index[doc_id], **_score_fields(doc_id, score_map, sim_map)}
+        for doc_id in doc_ids
+    ]
+
+
+def _build_context(doc_ids, doc_index, doc_texts):
+    return [
+        f"[{doc_index[doc_id]}] {_doc_render(doc_id, doc_texts.get(doc_id))['ctx']}"
+        for doc_id in doc_ids
+    ]
+
+
+def _docs_event(
+    docs_delta, doc_list, new_ids, updated_ids, doc_index, score_map, sim_map, doc_texts
+):
+    if not docs_delta:
+        payload = {
+            "type": "docs",
+            "documents": _build_docs_payload(
+                doc_list, doc_index, score_map, sim_map, doc_texts
+            ),
+        }
+    else:
+        payload = {
+            "type": "docs",
+            "mode": "delta",
+            "documents": _build_docs_payload(
+                new_ids, doc_index, score_map, sim_map, doc_texts
+            ),
+            "scores": _build_score_updates(updated_ids, doc_index, score_map, sim_map),
+        }
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+class AdmissionController:
+    """Caps concurrent pipelines; extra requests wait in a bounded FIFO queue."""
+
+    def __init__(self, max_active, max_queue):
+        self.max_active = max_active
+        self.max_queue = max_queue
+        self.active = 0
+        self.admitted = set()
+        self.queue = deque()
+
+    def full(self):
+        return self.active >= self.max_active and len(self.queue) >= self.max_queue
+
+    def enter(self):
+        ticket = asyncio.get_running_loop().create_future()
+        if self.active < self.max_active and not self.queue:
+            self._admit(ticket)
+        else:
+            self.queue.append(ticket)
+        return ticket
+
+    def position(self, ticket):
+        try:
+            return self.queue.index(ticket) + 1
+        except ValueError:
+            return 0
+
+    def leave(self, ticket):
+        # Idempotent: called from the stream's finally and again as a background task.
+        if ticket in self.queue:
+            self.queue.remove(ticket)
+            return
+        if ticket in self.admitted:
+            self.admitted.discard(ticket)
+            self.active -= 1
+            self._wake()
+
+    def _admit(self, ticket):
+        self.active += 1
+        self.admitted.add(ticket)
+        ticket.set_result(None)
+
+    def _wake(self):
+        while self.active < self.max_active and self.queue:
+            ticket = self.queue.popleft()
+            if ticket.done():
+                continue
+            self._admit(ticket)
+
+
+admission = AdmissionController(MAX_CONCURRENT_PIPELINES, MAX_QUEUE)
+sessions = SessionStore(SESSION_MAX, SESSION_MAX_BYTES, SESSION_TTL_S)
+
+
+async def _run(scope, fn, *args, **kwargs):
+    # Pipeline stages block on upstream calls; run them off the event loop so
+    # disconnects are noticed, and bind them to the request's deadline/cancel.
+    deadline, cancel = scope
 
+    def call():
+        with request_scope(deadline=deadline, cancel=cancel):
+            return fn(*args, **kwargs)
+
+    return await asyncio.to_thread(call)
+
+
+async def rag_stream(
+    query: str,
+    relax_context: bool = False,
+    docs_delta: bool = False,
+    verify_mode: str = DEFAULT_VERIFY_MODE,
+    deadline_s: Optional[float] = None,
+    request: Optional[Request] = None,
+    conversation_id: str = "",
+):
+    cancel = threading.Event()
+    try:
+        async for event in _pipeline_stream(
+            query,
+            relax_context,
+            docs_delta,
+            verify_mode,
+            deadline_s,
+            request,
+            cancel,
+            conversation_id,
+        ):
+            yield event
+    except Cancelled:
+        return
+    finally:
+        # Finished, failed or the client went away: abandon pending upstream calls.
+        cancel.set()
+
+
+def _save_session(conversation_id, warm_session, doc_list, score_map, sim_map, query_vec):
+    # warm_session is the session this turn started from; a cold turn passes
+    # None so an unrelated earlier pool is not carried forward.
+    pool = list(doc_list)
+    rrf = dict(score_map)
+    sim = dict(sim_map)
+    if warm_session is not None:
+        seen = set(pool)
+        pool.extend(d for d in warm_session.doc_ids if d not in seen)
+        for d in warm_session.doc_ids:
+            rrf.setdefault(d, warm_session.rrf_scores.get(d))
+            sim.setdefault(d, warm_session.sim_scores.get(d))
+    pool = pool[:SESSION_POOL_SIZE]
+    sessions.put(
+        conversation_id,
+        RetrievalSession(
+            pool,
+            {d: rrf.get(d) for d in pool},
+            {d: sim.get(d) for d in pool},
+            query_vec,
+        ),
+    )
 
-async def rag_stream(query: str, relax_context: bool = False):
+
+async def _pipeline_stream(
+    query,
+    relax_context,
+    docs_delta,
+    verify_mode,
+    deadline_s,
+    request,
+    cancel,
+    conversation_id="",
+):
+    if verify_mode not in VERIFY_MODES:
+        verify_mode = VERIFY_MODE
     clean_query, meta_only = parse_meta_only(query)
     clean_query, filters = parse_filters(clean_query)
     allowed = filter_doc_ids(metas, filters)
 
     refined_q = ""
     doc_list = []
+    ctx = []
     doc_index = {}
+    doc_texts = {}
     score_map = {}
     sim_map = {}
     final_answer = ""
     action = ""
-    mode = "other"
+    mode, mode_source = "other", "default"
+    budget = Budget(deadline_s)
+    scope = (budget.deadline, cancel)
+
+    # Follow-ups in the same conversation start from the previous turns' pool
+    # when the new question is still close to the last one.
+    use_session = bool(conversation_id) and not meta_only
+    session = sessions.get(conversation_id) if use_session else None
+    query_vec = None
+    warm = None
+    if session is not None:
+        try:
+            query_vec = (await _run(scope, embed_many, [clean_query]))[0]
+        except GatewayTimeout:
+            session = None
+        else:
+            if session.similarity(query_vec) >= SESSION_MIN_SIM:
+                warm = session.doc_ids
 
     for round_idx in range(MAX_ROUNDS):
-        mode = classify_query(clean_query)
-        queries = build_queries(clean_query, mode, extra_hint=refined_q)
+        if request is not None and await request.is_disconnected():
+            return
+        # Near the deadline, return the best answer so far instead of another round.
+        if final_answer and not budget.allows("answer"):
+            break
+        round_warm = warm if round_idx == 0 else None
+        # Follow-ups often change intent ("compare" after "when"), so classify
+        # every turn rather than inheriting the session's mode.
+        mode, mode_source = await _run(scope, classify_query_source, clean_query)
         if meta_only:
             weights = {"title": 1.0, "bm25": 1.0}
             use_indices = {"title": index_title}
@@ -127,16 +380,38 @@ async def rag_stream(query: str, relax_context: bool = False):
             use_indices = indices
             use_bm25 = bm25
 
-        cand, rrf_scores, sim_scores = rrf_search_multi(
-            use_indices, use_bm25, queries, TOP_K_RETRIEVE, weights, allowed=allowed
-        )
-        cand = lexical_prerank(clean_query, metas, cand, use_bm25, PRE_RERANK_TOP_K)
-        final_ids = rerank(clean_query, metas, cand)
+        try:
+            _, final_ids, rrf_scores, sim_scores, decisive, texts = await _run(
+                scope,
+                budgeted_retrieve,
+                clean_query,
+                mode,
+                metas,
+                use_indices,
+                use_bm25,
+                weights,
+                allowed=allowed,
+                extra_hint=refined_q,
+                budget=budget,
+                warm=round_warm,
+            )
+        except GatewayTimeout:
+            # Out of time mid-retrieval: stop here with the best answer so far.
+            break
+        if round_warm:
+            rrf_scores = {**session.rrf_scores, **rrf_scores}
+            sim_scores = {**session.sim_scores, **sim_scores}
 
+        new_ids = []
+        updated_ids = []
         for doc_id in final_ids:
             if doc_id in doc_index:
-                score_map[doc_id] = rrf_scores.get(doc_id, score_map.get(doc_id))
-                sim_map[doc_id] = sim_scores.get(doc_id, sim_map.get(doc_id))
+                rrf = rrf_scores.get(doc_id, score_map.get(doc_id))
+                sim = sim_scores.get(doc_id, sim_map.get(doc_id))
+                if rrf != score_map.get(doc_id) or sim != sim_map.get(doc_id):
+                    updated_ids.append(doc_id)
+                score_map[doc_id] = rrf
+                sim_map[doc_id] = sim
                 continue
             if len(doc_list) >= MAX_CTX_DOCS:
                 continue
@@ -144,23 +419,44 @@ async def rag_stream(query: str, relax_context: bool = False):
             doc_index[doc_id] = len(doc_list)
             score_map[doc_id] = rrf_scores.get(doc_id)
             sim_map[doc_id] = sim_scores.get(doc_id)
-
-        ctx = _build_context(doc_list, doc_index)
-        docs_payload = _build_docs_payload(doc_list, doc_index, score_map, sim_map)
-        yield f"data: {json.dumps({'type': 'docs', 'documents': docs_payload}, ensure_ascii=False)}\n\n"
+            if doc_id in texts:
+                doc_texts[doc_id] = texts[doc_id]
+            new_ids.append(doc_id)
+
+        # doc_index only grows, so the context list is extended in place.
+        ctx.extend(_build_context(new_ids, doc_index, doc_texts))
+        if round_idx == 0 or new_ids or updated_ids or not docs_delta:
+            yield _docs_event(
+                docs_delta,
+                doc_list,
+                new_ids,
+                updated_ids,
+                doc_index,
+                score_map,
+                sim_map,
+                doc_texts,
+            )
         await asyncio.sleep(0)
 
-        resp = answer_or_request(
+        resp = await _run(
+            scope,
+            answer_or_request,
             query,
             ctx,
-            allow_more=(round_idx < MAX_ROUNDS - 1),
+            allow_more=(
+                round_idx < MAX_ROUNDS - 1 and budget.allows("expand", "answer", "answer")
+            ),
             relax_context=relax_context,
             mode=mode,
+            inline_verify=(verify_mode == "inline"),
         )
+        if not resp and final_answer:
+            # Timed out or unparseable: keep the previous round's answer.
+            break
         action = resp.get("action", "")
         if action == "search_more":
-            refined_q = resp.get("query", "").strip() or refine_query(
-                clean_query, "more specific evidence"
+            refined_q = resp.get("query", "").strip() or await _run(
+                scope, refine_query, clean_query, "more specific evidence"
             )
             continue
         if action == "need_config":
@@ -177,14 +473,48 @@ async def rag_stream(query: str, relax_context: bool = False):
 
         if relax_context:
             break
-        supported, missing = verify_answer(query, ctx, final_answer)
+        if budget.adaptive and (decisive or not budget.allows("verify", "answer")):
+            budget.skip("verify")
+            break
+        supported, missing = await _run(
+            scope, check_answer, query, ctx, final_answer, resp=resp, mode=verify_mode
+        )
         if supported:
             break
-        refined_q = refine_query(clean_query, missing)
+        refined_q = await _run(scope, refine_query, clean_query, missing)
 
-    if not doc_list and not final_answer:
+    if not final_answer:
         final_answer = NOT_FOUND_MSG
 
+    # Same log the CLI writes; LLM-labelled rows feed the query classifier.
+    await asyncio.to_thread(
+        log_event,
+        STORE_DIR,
+        {
+            "query": query,
+            "clean_query": clean_query,
+            "mode": mode,
+            "mode_source": mode_source,
+            "answer": final_answer,
+        },
+    )
+
+    if use_session and doc_list:
+        try:
+            if query_vec is None:
+                query_vec = (await _run(scope, embed_many, [clean_query]))[0]
+        except GatewayTimeout:
+            query_vec = None
+        if query_vec is not None:
+            _save_session(
+                conversation_id,
+                session if warm else None,
+                doc_list,
+                score_map,
+                sim_map,
+                query_vec,
+            )
+
     full_text = ""
     chunk_size = 3
     for i in range(0, len(final_answer), chunk_size):
@@ -196,11 +526,50 @@ async def rag_stream(query: str, relax_context: bool = False):
     yield f"data: {json.dumps({'type': 'done', 'full_answer': full_text}, ensure_ascii=False)}\n\n"
 
 
+async def _admitted_stream(req: ChatRequest, request: Request, ticket):
+    try:
+        last_pos = None
+        while not ticket.done():
+            pos = admission.position(ticket)
+            if pos != last_pos:
+                last_pos = pos
+                yield f"data: {json.dumps({'type': 'queue', 'position': pos})}\n\n"
+            try:
+                await asyncio.wait_for(asyncio.shield(ticket), timeout=QUEUE_POLL_S)
+            except asyncio.TimeoutError:
+                if await request.is_disconnected():
+                    return
+        async for event in rag_stream(
+            req.query,
+            relax_context=req.relax_context,
+            docs_delta=req.docs_delta,
+            verify_mode=req.verify_mode,
+            deadline_s=req.deadline_s,
+            request=request,
+            conversation_id=req.conversation_id,
+        ):
+            yield event
+    finally:
+        admission.leave(ticket)
+
+
+async def _release(ticket):
+    admission.leave(ticket)
+
+
 @app.post("/api/chat")
-async def chat_endpoint(req: ChatRequest):
+async def chat_endpoint(req: ChatRequest, request: Request):
+    if admission.full():
+        return JSONResponse(
+            {"detail": "Server busy, try again shortly."},
+            status_code=429,
+            headers={"Retry-After": "5"},
+        )
+    ticket = admission.enter()
     return StreamingResponse(
-        rag_stream(req.query, relax_context=req.relax_context),
+        _admitted_stream(req, request, ticket),
         media_type="text/event-stream",
+        background=BackgroundTask(_release, ticket),
         headers={
             "Cache-Control": "no-cache",
             "Connection": "keep-alive",
@@ -211,7 +580,13 @@ async def chat_endpoint(req: ChatRequest):
 
 @app.get("/api/health")
 async def health():
-    return {"status": "ok", "timestamp": time.time()}
+    return {
+        "status": "ok",
+        "timestamp": time.time(),
+        "llm": dict(gateway.stats),
+        "pipelines": {"active": admission.active, "queued": len(admission.queue)},
+        "sessions": {"count": len(sessions), "bytes": sessions.nbytes},
+    }
 
 
 if __name__ == "__main__":
@@ -11,6 +11,32 @@ interface SendOptions {
   relaxContext?: boolean;
 }
 
+interface DocScoreUpdate {
+  index: number;
+  rrf_score?: number | null;
+  sim_score?: number | null;
+}
+
+// Delta "docs" events carry only newly added documents plus score updates
+// for documents the client already has.
+function mergeDocsDelta(
+  prev: RetrievedDoc[],
+  added: RetrievedDoc[] = [],
+  scores: DocScoreUpdate[] = []
+): RetrievedDoc[] {
+  const updates = new Map(scores.map((s) => [s.index, s]));
+  const merged = prev.map((doc) => {
+    const u = doc.index !== undefined ? updates.get(doc.index) : undefined;
+    if (!u) return doc;
+    return {
+      ...doc,
+      rrf_score: u.rrf_score ?? undefined,
+      sim_score: u.sim_score ?? undefined,
+    };
+  });
+  return [...merged, ...added];
+}
+
 export function useChatStream({
   conversationId,
   onConversationCreated,
@@ -111,6 +137,7 @@ export function useChatStream({
             query: content,
             conversation_id: activeConvId,
             relax_context: Boolean(options.relaxContext),
+            docs_delta: true,
           }),
           signal: abortController.signal,
         });
@@ -144,7 +171,10 @@ export function useChatStream({
                 fullContent += event.content;
                 setStreamingContent(fullContent);
               } else if (event.type === "docs") {
-                docs = event.documents || [];
+                docs =
+                  event.mode === "delta"
+                    ? mergeDocsDelta(docs, event.documents, event.scores)
+                    : event.documents || [];
                 setStreamingDocs(docs);
               } else if (event.type === "done") {
                 fullContent = event.full_answer || fullContent;
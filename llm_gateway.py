@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+"""
+Gateway for every OpenAI call made by the RAG pipeline.
+
+- per-call deadlines (also capped by the surrounding request scope)
+- bounded retries with backoff for transient upstream errors
+- hedged duplicate requests for idempotent helpers, fired at each helper's
+  observed p95 latency
+- token-bucket + concurrency limits that follow x-ratelimit-* headers
+- one pooled keep-alive HTTP client shared by all calls
+
+Attempts run as tasks on a private event loop (AsyncOpenAI over
+httpx.AsyncClient) while call() stays synchronous for the pipeline threads.
+Abandoning an attempt on cancel, deadline or a won hedge cancels its task,
+which closes the upstream connection and frees its slot; nothing keeps
+running in the background.
+
+Point OPENAI_BASE_URL (or Gateway(base_url=...)) at a local fake server to
+exercise it without the real API.
+"""
+import os, re, time, asyncio, threading, contextvars
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, wait
+import httpx
+import openai
+from openai import AsyncOpenAI
+
+DEFAULT_TIMEOUT=float(os.environ.get("RAG_LLM_TIMEOUT","60"))
+HEDGE_DELAY=float(os.environ.get("RAG_LLM_HEDGE_DELAY","1"))  # floor for the p95-based delay
+MAX_CONCURRENCY=int(os.environ.get("RAG_LLM_CONCURRENCY","16"))
+RATE_PER_SEC=float(os.environ.get("RAG_LLM_RATE","20"))
+RATE_BURST=int(os.environ.get("RAG_LLM_BURST","40"))
+POOL_SIZE=int(os.environ.get("RAG_LLM_POOL","32"))
+MAX_RETRIES=int(os.environ.get("RAG_LLM_RETRIES","2"))
+RETRY_BACKOFF=0.5
+RATE_LIMIT_PAUSE=1.0
+HEDGE_WINDOW=50
+HEDGE_MIN_SAMPLES=10
+POLL_INTERVAL=0.05
+
+DURATION_RE=re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+
+_deadline=contextvars.ContextVar("llm_deadline",default=None)
+_cancel=contextvars.ContextVar("llm_cancel",default=None)
+
+
+class GatewayTimeout(Exception):
+    pass
+
+
+class Cancelled(BaseException):
+    """Raised when the request scope is cancelled.
+
+    BaseException so the pipeline's broad `except Exception` fallbacks do not
+    swallow it, mirroring asyncio.CancelledError.
+    """
+
+
+def parse_duration(s):
+    if not s:
+        return 0.0
+    total=0.0
+    for num,unit in DURATION_RE.findall(str(s)):
+        total+=float(num)*{"ms":0.001,"s":1.0,"m":60.0,"h":3600.0}[unit]
+    return total
+
+
+def parse_retry_after(headers):
+    ms=headers.get("retry-after-ms")
+    if ms:
+        try:
+            return float(ms)/1000.0
+        except ValueError:
+            pass
+    try:
+        return float(headers.get("retry-after") or 0.0)
+    except ValueError:
+        return 0.0
+
+
+@contextmanager
+def request_scope(deadline=None,cancel=None):
+    """Bound every gateway call inside the block by a monotonic deadline and/or a threading.Event."""
+    t1=_deadline.set(deadline)
+    t2=_cancel.set(cancel)
+    try:
+        yield
+    finally:
+        _deadline.reset(t1)
+        _cancel.reset(t2)
+
+
+def current_scope():
+    """(deadline, cancel) of the enclosing request_scope, for helpers that wait outside the gateway."""
+    return _deadline.get(),_cancel.get()
+
+
+def check_cancelled():
+    ev=_cancel.get()
+    if ev is not None and ev.is_set():
+        raise Cancelled()
+
+
+class TokenBucket:
+    def __init__(self,rate,capacity):
+        self.rate=rate
+        self.capacity=capacity
+        self.tokens=float(capacity)
+        self.updated=time.monotonic()
+        self.blocked_until=0.0
+        self.lock=threading.Lock()
+
+    def _refill(self,now):
+        self.tokens=min(self.capacity,self.tokens+(now-self.updated)*self.rate)
+        self.updated=now
+
+    async def acquire(self,deadline=None,cancel=None):
+        while True:
+            if cancel is not None and cancel.is_set():
+                raise Cancelled()
+            now=time.monotonic()
+            with self.lock:
+                self._refill(now)
+                if now>=self.blocked_until and self.tokens>=1.0:
+                    self.tokens-=1.0
+                    return
+                wait_s=max(self.blocked_until-now,(1.0-self.tokens)/self.rate if self.rate>0 else POLL_INTERVAL)
+            if deadline is not None and now+wait_s>deadline:
+                raise GatewayTimeout("rate limit wait exceeds deadline")
+            await asyncio.sleep(min(wait_s,POLL_INTERVAL))
+
+    def update_from_headers(self,headers,status=None):
+        now=time.monotonic()
+        pause=0.0
+        if status==429:
+            # Rate limited: wait out retry-after (or the request reset window)
+            # before any hedge or retry goes back upstream.
+            pause=(
+                parse_retry_after(headers)
+                or parse_duration(headers.get("x-ratelimit-reset-requests"))
+                or RATE_LIMIT_PAUSE
+            )
+        remaining=headers.get("x-ratelimit-remaining-requests")
+        try:
+            remaining=float(remaining) if remaining is not None else None
+        except ValueError:
+            remaining=None
+        if remaining is not None and remaining<=0:
+            pause=max(pause,parse_duration(headers.get("x-ratelimit-reset-requests")))
+        with self.lock:
+            self._refill(now)
+            if remaining is not None:
+                self.tokens=min(self.tokens,remaining)
+            if pause>0:
+                self.blocked_until=max(self.blocked_until,now+pause)
+
+
+def is_retryable(err):
+    if isinstance(err,(openai.APIConnectionError,openai.RateLimitError,openai.InternalServerError)):
+        return True
+    if isinstance(err,openai.APIStatusError):
+        return err.status_code in (408,409,429) or err.status_code>=500
+    return False
+
+
+class Gateway:
+    def __init__(
+        self,
+        base_url=None,
+        api_key=None,
+        timeout=DEFAULT_TIMEOUT,
+        hedge_delay=HEDGE_DELAY,
+        max_concurrency=MAX_CONCURRENCY,
+        rate=RATE_PER_SEC,
+        burst=RATE_BURST,
+        pool_size=POOL_SIZE,
+        max_retries=MAX_RETRIES,
+    ):
+        self.timeout=timeout
+        self.hedge_delay=hedge_delay
+        self.max_retries=max_retries
+        self.loop=asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever,name="llm-gateway",daemon=True).start()
+        self.http=httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=pool_size,
+                max_keepalive_connections=pool_size,
+                keepalive_expiry=60.0,
+            ),
+            timeout=timeout,
+        )
+        # Retries are handled here (bounded backoff + hedging), not by the SDK.
+        self.client=AsyncOpenAI(base_url=base_url,api_key=api_key,http_client=self.http,max_retries=0,timeout=timeout)
+        # Held for the whole attempt; cancelled attempts end promptly, so this
+        # bounds the upstream requests actually open.
+        self.sem=asyncio.Semaphore(max_concurrency)
+        self.in_flight=0
+        self.bucket=TokenBucket(rate,burst)
+        self.latency={}
+        self.stats={
+            "calls":0,"hedges":0,"hedge_wins":0,"retries":0,
+            "timeouts":0,"errors":0,"cancelled":0,"abandoned":0,
+        }
+        self._lock=threading.Lock()
+
+    def _count(self,key,n=1):
+        with self._lock:
+            self.stats[key]+=n
+
+    def _record(self,key,elapsed):
+        with self._lock:
+            self.latency.setdefault(key,deque(maxlen=HEDGE_WINDOW)).append(elapsed)
+
+    def latency_quantile(self,key,q):
+        """q-quantile of recent successful call latencies for key; None until enough samples."""
+        with self._lock:
+            samples=sorted(self.latency.get(key,()))
+        if len(samples)<HEDGE_MIN_SAMPLES:
+            return None
+        return samples[min(len(samples)-1,int(q*len(samples)))]
+
+    def hedge_delay_for(self,key):
+        """p95 latency for key (floored at hedge_delay); None until enough samples."""
+        p95=self.latency_quantile(key,0.95)
+        return None if p95 is None else max(self.hedge_delay,p95)
+
+    async def _attempt(self,fn,deadline,cancel,key):
+        await self.bucket.acquire(deadline,cancel)
+        try:
+            await asyncio.wait_for(self.sem.acquire(),max(0.0,deadline-time.monotonic()))
+        except asyncio.TimeoutError:
+            raise GatewayTimeout("no free upstream slot before deadline") from None
+        self._count_in_flight(1)
+        try:
+            if cancel is not None and cancel.is_set():
+                raise Cancelled()
+            t0=time.monotonic()
+            try:
+                raw=await fn(max(0.001,deadline-time.monotonic()))
+            except openai.APIStatusError as e:
+                self.bucket.update_from_headers(e.response.headers,status=e.status_code)
+                raise
+            self.bucket.update_from_headers(raw.headers)
+            parsed=raw.parse()
+            self._record(key,time.monotonic()-t0)
+            return parsed
+        finally:
+            self._count_in_flight(-1)
+            self.sem.release()
+
+    def _count_in_flight(self,n):
+        with self._lock:
+            self.in_flight+=n
+
+    def _abandon(self,futures):
+        # Cancelling the task aborts its HTTP request and releases its slot.
+        for f in futures:
+            f.cancel()
+        if futures:
+            self._count("abandoned",len(futures))
+
+    def call(self,fn,timeout=None,hedge=False,key="default"):
+        """Run fn(timeout) -> awaitable raw response with a deadline, bounded retries and optional hedge.
+
+        fn must be idempotent when hedge=True. Hedging for key starts once its
+        p95 latency is known. Returns the parsed response. Pending attempts
+        are cancelled on cancel, deadline or once one attempt succeeds.
+        """
+        self._count("calls")
+        now=time.monotonic()
+        deadline=now+(timeout or self.timeout)
+        scope_deadline=_deadline.get()
+        if scope_deadline is not None:
+            deadline=min(deadline,scope_deadline)
+        cancel=_cancel.get()
+        check_cancelled()
+
+        futures={}
+
+        def submit(kind):
+            coro=self._attempt(fn,deadline,cancel,key)
+            futures[asyncio.run_coroutine_threadsafe(coro,self.loop)]=kind
+
+        submit("primary")
+        delay=self.hedge_delay_for(key) if hedge else None
+        hedge_at=now+delay if delay is not None else None
+        retries=0
+        retry_at=None
+        last_err=None
+        while True:
+            now=time.monotonic()
+            if cancel is not None and cancel.is_set():
+                self._count("cancelled")
+                self._abandon(futures)
+                raise Cancelled()
+            if now>=deadline:
+                self._count("timeouts")
+                self._abandon(futures)
+                raise GatewayTimeout("upstream call exceeded its deadline")
+            if retry_at is not None and now>=retry_at:
+                retry_at=None
+                self._count("retries")
+                submit("retry")
+            if not futures and retry_at is None:
+                self._count("errors")
+                if isinstance(last_err,GatewayTimeout):
+                    self._count("timeouts")
+                raise last_err
+            step=deadline-now
+            for t in (hedge_at,retry_at):
+                if t is not None:
+                    step=min(step,max(0.0,t-now))
+            if cancel is not None:
+                step=min(step,POLL_INTERVAL)
+            if futures:
+                done,_=wait(list(futures),timeout=step,return_when=FIRST_COMPLETED)
+            else:
+                done=set()
+                time.sleep(step)
+            for f in done:
+                kind=futures.pop(f)
+                err=f.exception()
+                if err is None:
+                    if kind=="hedge":
+                        self._count("hedge_wins")
+                    self._abandon(futures)
+                    return f.result()
+                last_err=err
+            if hedge_at is not None and time.monotonic()>=hedge_at and futures:
+                # One duplicate once the in-flight attempt is slower than this helper's p95.
+                hedge_at=None
+                self._count("hedges")
+                submit("hedge")
+            if done and not futures and retry_at is None:
+                if retries<self.max_retries and is_retryable(last_err):
+                    # The bucket has already been paused from any 429 headers,
+                    # so the retry waits behind it in _attempt.
+                    retry_at=time.monotonic()+RETRY_BACKOFF*(2**retries)
+                    retries+=1
+
+    def respond(self,model,prompt,timeout=None,hedge=False,key="respond"):
+        resp=self.call(
+            lambda t: self.client.with_raw_response.responses.create(model=model,input=prompt,timeout=t),
+            timeout=timeout,
+            hedge=hedge,
+            key=key,
+        )
+        return resp.output_text
+
+    def embed(self,model,inputs,timeout=None,hedge=True):
+        resp=self.call(
+            lambda t: self.client.with_raw_response.embeddings.create(model=model,input=inputs,timeout=t),
+            timeout=timeout,
+            hedge=hedge,
+            key="embed",
+        )
+        return [d.embedding for d in resp.data]
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Cross-request micro-batching for embeddings and FAISS search.
+
+Concurrent pipelines submit work from their worker threads; a collector
+thread gathers whatever arrives within a short window (up to a max batch)
+and hands the batch to a small executor, which issues one embeddings call /
+one matrix search per index and scatters the results back. Up to max_in_flight
+batches run at once; while they are all busy, new arrivals keep accumulating
+into the next batch. When the batcher is idle the first item is dispatched at
+once (idle meaning no batch in flight), so a lone request does not pay the
+window.
+"""
+import time, queue, threading
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+import numpy as np
+from llm_gateway import GatewayTimeout, check_cancelled, current_scope
+
+POLL_INTERVAL=0.05
+MAX_IN_FLIGHT=4
+
+
+class MicroBatcher:
+    def __init__(self,fn,window_ms=3.0,max_batch=64,size=len,name="batch",max_in_flight=MAX_IN_FLIGHT):
+        """fn(items) -> results (same order). size(item) counts toward max_batch."""
+        self.fn=fn
+        self.window=window_ms/1000.0
+        self.max_batch=max_batch
+        self.size=size
+        self.q=queue.Queue()
+        self.slots=threading.BoundedSemaphore(max_in_flight)
+        self.pool=ThreadPoolExecutor(max_workers=max_in_flight,thread_name_prefix=f"microbatch-{name}-run")
+        self._in_flight=0
+        self._lock=threading.Lock()
+        self.stats={"batches":0,"items":0}
+        threading.Thread(target=self._loop,name=f"microbatch-{name}",daemon=True).start()
+
+    def submit(self,item):
+        fut=Future()
+        self.q.put((item,fut))
+        deadline,_=current_scope()
+        while True:
+            check_cancelled()
+            step=POLL_INTERVAL
+            if deadline is not None:
+                step=min(step,deadline-time.monotonic())
+                if step<=0:
+                    raise GatewayTimeout("batched call exceeded its deadline")
+            try:
+                return fut.result(timeout=step)
+            except FutureTimeout:
+                continue
+
+    def _collect(self):
+        item=self.q.get()
+        batch=[item]
+        n=self.size(item[0])
+        with self._lock:
+            idle=self._in_flight==0
+        if self.q.empty() and idle:
+            return batch
+        end=time.monotonic()+self.window
+        while n<self.max_batch:
+            remaining=end-time.monotonic()
+            if remaining<=0:
+                break
+            try:
+                item=self.q.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(item)
+            n+=self.size(item[0])
+        return batch
+
+    def _run(self,batch):
+        try:
+            results=self.fn([item for item,_ in batch])
+        except Exception as e:
+            for _,fut in batch:
+                fut.set_exception(e)
+            return
+        finally:
+            with self._lock:
+                self._in_flight-=1
+            self.slots.release()
+        for (_,fut),res in zip(batch,results):
+            fut.set_result(res)
+
+    def _loop(self):
+        # The collector only groups; batches run on the pool. Waiting for a
+        # free slot happens before collecting, so arrivals during that wait
+        # join the next batch instead of queuing behind the running ones.
+        while True:
+            self.slots.acquire()
+            batch=self._collect()
+            with self._lock:
+                self._in_flight+=1
+            self.stats["batches"]+=1
+            self.stats["items"]+=len(batch)
+            self.pool.submit(self._run,batch)
+
+
+class BatchedEmbedder:
+    """Merges concurrent embed requests into one deduplicated embeddings call."""
+
+    def __init__(self,gateway,model,window_ms=3.0,max_batch=64,timeout=None,max_in_flight=MAX_IN_FLIGHT):
+        self.gateway=gateway
+        self.model=model
+        self.timeout=timeout
+        self.batcher=MicroBatcher(
+            self._embed_batch,window_ms,max_batch,size=len,name="embed",max_in_flight=max_in_flight,
+        )
+
+    def _embed_batch(self,items):
+        uniq=list(dict.fromkeys(t for texts in items for t in texts))
+        vecs=dict(zip(uniq,self.gateway.embed(self.model,uniq,timeout=self.timeout)))
+        return [[vecs[t] for t in texts] for texts in items]
+
+    def embed(self,texts):
+        return self.batcher.submit(list(texts))
+
+
+class BatchedIndex:
+    """FAISS index wrapper whose search() is batched with concurrent callers."""
+
+    def __init__(self,index,window_ms=3.0,max_batch=64,max_in_flight=MAX_IN_FLIGHT):
+        self.index=index
+        self.batcher=MicroBatcher(
+            self._search_batch,window_ms,max_batch,size=lambda it:it[0].shape[0],name="search",
+            max_in_flight=max_in_flight,
+        )
+
+    def __getattr__(self,name):
+        return getattr(self.index,name)
+
+    def _search_batch(self,items):
+        k=max(k for _,k in items)
+        D,I=self.index.search(np.vstack([x for x,_ in items]),k)
+        out=[]
+        row=0
+        for x,kk in items:
+            n=x.shape[0]
+            out.append((D[row:row+n,:kk],I[row:row+n,:kk]))
+            row+=n
+        return out
+
+    def search(self,x,k):
+        return self.batcher.submit((np.ascontiguousarray(x,dtype=np.float32),k))
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Local query-type classifier used ahead of the classify_query LLM call.
+
+Nearest-centroid over the (L2-normalised) query embedding plus lexical cue
+bonuses. Centroids are trained from hand-labelled queries and/or the
+query log and stored next to the FAISS indices in the rag_store. Only log
+rows labelled by the LLM (mode_source "llm") are used, so the classifier
+never trains on its own predictions, and they train on clean_query, the
+filter-free text the classifier actually saw.
+
+Usage:
+    python query_classifier.py --store-dir rag_store [--labels labels.jsonl]
+"""
+import os, json, argparse
+import numpy as np
+
+LABELS=("definition","comparison","multi-hop","list","other")
+MODEL_FILE="query_classifier.npz"
+TRUSTED_LOG_SOURCES=("llm",)
+MIN_EXAMPLES_PER_LABEL=5
+CUE_WEIGHT=0.08
+TEMPERATURE=0.05
+CUES={
+    "comparison":("비교","차이","다른 점","공통점","versus","vs"),
+    "definition":("무엇","뜻","정의","이란","란?","무슨 의미"),
+    "list":("목록","나열","모두","전부","어떤 것들","열거"),
+    "multi-hop":("왜","어떻게","영향","결과","때문","이후","배경"),
+}
+
+
+def cue_vector(q):
+    q=(q or "").lower()
+    return np.array([1.0 if any(c in q for c in CUES.get(l,())) else 0.0 for l in LABELS],dtype=np.float32)
+
+
+class QueryClassifier:
+    def __init__(self,centroids,counts):
+        self.centroids=np.asarray(centroids,dtype=np.float32)
+        self.counts=np.asarray(counts,dtype=np.int64)
+
+    @classmethod
+    def load(cls,path):
+        data=np.load(path,allow_pickle=False)
+        labels=tuple(str(x) for x in data["labels"])
+        if labels!=LABELS:
+            raise ValueError(f"label mismatch in {path}: {labels}")
+        return cls(data["centroids"],data["counts"])
+
+    def save(self,path):
+        np.savez(path,labels=np.array(LABELS),centroids=self.centroids,counts=self.counts)
+
+    @classmethod
+    def fit(cls,vecs,labels):
+        vecs=np.asarray(vecs,dtype=np.float32)
+        dim=vecs.shape[1]
+        centroids=np.zeros((len(LABELS),dim),dtype=np.float32)
+        counts=np.zeros(len(LABELS),dtype=np.int64)
+        for li,label in enumerate(LABELS):
+            rows=[i for i,l in enumerate(labels) if l==label]
+            if not rows:
+                continue
+            c=vecs[rows].mean(axis=0)
+            n=np.linalg.norm(c)
+            centroids[li]=c/n if n>0 else c
+            counts[li]=len(rows)
+        return cls(centroids,counts)
+
+    def predict(self,vec,q=""):
+        """Return (label, confidence) where confidence is the softmax top probability.
+
+        A model missing any label cannot rule that label out, so it reports
+        zero confidence and the caller falls back to the LLM.
+        """
+        if (self.counts<=0).any():
+            return "other",0.0
+        scores=self.centroids@np.asarray(vec,dtype=np.float32)
+        scores=scores+CUE_WEIGHT*cue_vector(q)
+        z=(scores-scores.max())/TEMPERATURE
+        p=np.exp(z)
+        p/=p.sum()
+        best=int(np.argmax(p))
+        return LABELS[best],float(p[best])
+
+
+def load_examples(store_dir,labels_path=None):
+    examples={}
+    log_path=os.path.join(store_dir,"logs","query_log.jsonl")
+    sources=[(log_path,True),(labels_path,False)]
+    # Later sources win, so hand labels override logged LLM labels.
+    for path,from_log in sources:
+        if not path or not os.path.exists(path):
+            continue
+        with open(path,"r",encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    row=json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if from_log and row.get("mode_source") not in TRUSTED_LOG_SOURCES:
+                    continue
+                q=(row.get("clean_query" if from_log else "query") or "").strip()
+                label=row.get("mode") or row.get("label")
+                if q and label in LABELS:
+                    examples[q]=label
+    return examples
+
+
+def main():
+    ap=argparse.ArgumentParser()
+    ap.add_argument("--store-dir",default="rag_store")
+    ap.add_argument("--labels",default=None,help="jsonl with {\"query\",\"label\"} rows")
+    args=ap.parse_args()
+
+    from rag_query import embed_many
+
+    examples=load_examples(args.store_dir,args.labels)
+    if not examples:
+        print("no labelled queries found")
+        return
+    counts={l:0 for l in LABELS}
+    for label in examples.values():
+        counts[label]+=1
+    short={l:n for l,n in counts.items() if n<MIN_EXAMPLES_PER_LABEL}
+    if short:
+        print(f"not enough examples (need {MIN_EXAMPLES_PER_LABEL} per label): {short}")
+        return
+    queries=list(examples)
+    vecs=embed_many(queries)
+    clf=QueryClassifier.fit(vecs,[examples[q] for q in queries])
+    path=os.path.join(args.store_dir,MODEL_FILE)
+    clf.save(path)
+    print(f"saved {path} ({dict(zip(LABELS,clf.counts.tolist()))})")
+
+
+if __name__=="__main__":
+    main()
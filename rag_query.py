@@ -1,11 +1,16 @@
 #!/usr/bin/env python3
 import os, json, time, pickle, re, argparse
 import numpy as np, faiss
-from openai import OpenAI
+from openai import APIError
+from llm_gateway import Gateway, GatewayTimeout, request_scope
+from query_classifier import QueryClassifier, MODEL_FILE as CLASSIFIER_FILE
 
 STORE_DIR="rag_store"
 EMBED_MODEL="text-embedding-3-large"
 GEN_MODEL="gpt-5.2"
+GEN_TIMEOUT=60.0
+AUX_TIMEOUT=20.0
+EMBED_TIMEOUT=15.0
 TOP_K_RETRIEVE=60
 TOP_K_FINAL=8
 RRF_K=60
@@ -19,18 +24,39 @@ RELAX_CONTEXT=False
 MAX_QUERY_EXPANSIONS=10
 PRE_RERANK_TOP_K=64
 TITLE_MATCH_BONUS=0.5
+VERIFY_MODE="full"  # full | cited | inline
+VERIFY_MODES=("full","cited","inline")
+CLASSIFIER_MIN_CONF=0.6
+DECISIVE_SIM_MARGIN=0.06
+DECISIVE_TITLE_COVERAGE=1.0
+COLLAPSE_MODE="merge"  # merge | best | off
+COLLAPSE_MODES=("merge","best","off")
+COLLAPSE_CHAR_BUDGET=DOC_CHAR_LIMIT  # a merged passage replaces one doc slot in the prompt
+MIN_OVERLAP_CHARS=40
+# Rough per-stage latency estimates in seconds, used until the gateway has
+# seen enough successful calls for the stage's helpers (STAGE_KEYS).
+STAGE_COST={"expand":4.0,"rerank":4.0,"answer":10.0,"verify":5.0}
+STAGE_KEYS={
+    "expand":("decompose","step_back","multi","hyde"),
+    "rerank":("rerank",),
+    "answer":("answer",),
+    "verify":("verify",),
+}
 NOT_FOUND_MSG=(
     "제공된 데이터로는 답을 확정하기 어렵습니다. "
     "더 가져오고 싶어도 과도한 확장은 RAG의 본질적 한계와 맞닿아 있어, "
     "현 시점에선 확답이 어렵습니다."
 )
 
-client=OpenAI()
+gateway=Gateway()
 _embed_cache={}
+_classifier=None
+_embed_batcher=None
 
 FILTER_RE=re.compile(r"\b(title|link|row_id|chunk_id):(?:(\"[^\"]+\")|(\S+))",re.IGNORECASE)
 WORD_RE=re.compile(r"[A-Za-z0-9가-힣]+")
 META_ONLY_RE=re.compile(r"(?:^|\s)~(\S+)")
+CITE_RE=re.compile(r"\[(\d+)\]")
 
 
 def load_store(store_dir):
@@ -54,12 +80,27 @@ def load_store(store_dir):
     return index,index_sum,index_title,metas,bm25,bm25_title
 
 
+def load_classifier(store_dir):
+    global _classifier
+    path=os.path.join(store_dir,CLASSIFIER_FILE)
+    _classifier=QueryClassifier.load(path) if os.path.exists(path) else None
+    return _classifier
+
+
+def set_embed_batcher(batcher):
+    global _embed_batcher
+    _embed_batcher=batcher
+
+
 def embed_many(queries):
     missing=[q for q in queries if q not in _embed_cache]
     if missing:
-        resp=client.embeddings.create(model=EMBED_MODEL,input=missing)
-        for q,d in zip(missing,resp.data):
-            _embed_cache[q]=np.array(d.embedding,dtype=np.float32)
+        if _embed_batcher is not None:
+            vecs=_embed_batcher.embed(missing)
+        else:
+            vecs=gateway.embed(EMBED_MODEL,missing,timeout=EMBED_TIMEOUT)
+        for q,v in zip(missing,vecs):
+            _embed_cache[q]=np.array(v,dtype=np.float32)
     vecs=[_embed_cache[q] for q in queries]
     arr=np.array(vecs,dtype=np.float32)
     faiss.normalize_L2(arr)
@@ -71,6 +112,20 @@ def tokenize(t):
 
 
 def classify_query(q):
+    return classify_query_source(q)[0]
+
+
+def classify_query_source(q):
+    """Return (label, source) where source is "local", "llm" or "default"."""
+    # The query is embedded for retrieval anyway, so the local classifier costs
+    # no extra round-trip; the LLM is only asked when it is unsure.
+    if _classifier is not None:
+        try:
+            label,conf=_classifier.predict(embed_many([q])[0],q)
+            if conf>=CLASSIFIER_MIN_CONF:
+                return label,"local"
+        except Exception:
+            pass
     prompt=(
         "다음 질문을 다음 중 하나로 분류하세요: definition, comparison, multi-hop, list, other. "
         "라벨만 반환하세요.\n"
@@ -78,13 +133,13 @@ def classify_query(q):
         f"질문: {q}"
     )
     try:
-        resp=client.responses.create(model=GEN_MODEL,input=prompt)
-        label=resp.output_text.strip().lower()
+        out=gateway.respond(GEN_MODEL,prompt,timeout=AUX_TIMEOUT,hedge=True,key="classify")
+        label=out.strip().lower()
         if label in {"definition","comparison","multi-hop","list","other"}:
-            return label
+            return label,"llm"
     except Exception:
         pass
-    return "other"
+    return "other","default"
 
 
 def decompose_query(q,mode):
@@ -97,8 +152,8 @@ def decompose_query(q,mode):
         f"질문: {q}"
     )
     try:
-        resp=client.responses.create(model=GEN_MODEL,input=prompt)
-        return [l.strip().lstrip("--").strip() for l in resp.output_text.splitlines() if l.strip()]
+        out=gateway.respond(GEN_MODEL,prompt,timeout=AUX_TIMEOUT,hedge=True,key="decompose")
+        return [l.strip().lstrip("--").strip() for l in out.splitlines() if l.strip()]
     except Exception:
         return []
 
@@ -111,8 +166,8 @@ def step_back_query(q):
         f"질문: {q}"
     )
     try:
-        resp=client.responses.create(model=GEN_MODEL,input=prompt)
-        return resp.output_text.strip()
+        out=gateway.respond(GEN_MODEL,prompt,timeout=AUX_TIMEOUT,hedge=True,key="step_back")
+        return out.strip()
     except Exception:
         return ""
 
@@ -125,8 +180,8 @@ def multi_query(q):
         f"질문: {q}"
     )
     try:
-        resp=client.responses.create(model=GEN_MODEL,input=prompt)
-        return [l.strip().lstrip("--").strip() for l in resp.output_text.splitlines() if l.strip()]
+        out=gateway.respond(GEN_MODEL,prompt,timeout=AUX_TIMEOUT,hedge=True,key="multi")
+        return [l.strip().lstrip("--").strip() for l in out.splitlines() if l.strip()]
     except Exception:
         return []
 
@@ -139,8 +194,8 @@ def hyde_query(q):
         f"질문: {q}"
     )
     try:
-        resp=client.responses.create(model=GEN_MODEL,input=prompt)
-        return resp.output_text.strip()
+        out=gateway.respond(GEN_MODEL,prompt,timeout=AUX_TIMEOUT,hedge=True,key="hyde")
+        return out.strip()
     except Exception:
         return ""
 
@@ -173,6 +228,19 @@ def domain_expansions(q,mode):
     return ex
 
 
+def dedupe_queries(queries):
+    # Case-insensitive dedupe in order, capped at MAX_QUERY_EXPANSIONS.
+    seen=set()
+    out=[]
+    for s in queries:
+        key=s.lower()
+        if key in seen:
+            continue
+        seen.add(key)
+        out.append(s)
+    return out[:MAX_QUERY_EXPANSIONS]
+
+
 def build_queries(q,mode,extra_hint=""):
     queries=[q]
     subqs=decompose_query(q,mode)
@@ -187,15 +255,106 @@ def build_queries(q,mode,extra_hint=""):
     if extra_hint:
         queries.append(extra_hint)
     queries.extend(domain_expansions(q,mode))
-    seen=set()
-    out=[]
-    for s in queries:
-        key=s.lower()
-        if key in seen:
-            continue
-        seen.add(key)
-        out.append(s)
-    return out[:MAX_QUERY_EXPANSIONS]
+    return dedupe_queries(queries)
+
+
+def light_queries(q,mode,extra_hint=""):
+    queries=[q]
+    if extra_hint:
+        queries.append(extra_hint)
+    queries.extend(domain_expansions(q,mode))
+    return dedupe_queries(queries)
+
+
+def stage_cost(stage):
+    # Median of the gateway's successful calls only, so timeouts and slow
+    # unbudgeted requests do not inflate the estimate for everyone else.
+    known=[gateway.latency_quantile(k,0.5) for k in STAGE_KEYS.get(stage,())]
+    known=[t for t in known if t is not None]
+    return sum(known) if known else STAGE_COST.get(stage,0.0)
+
+
+class Budget:
+    """Per-request latency budget. Without a deadline every stage is allowed."""
+
+    def __init__(self,deadline_s=None):
+        self.start=time.monotonic()
+        self.deadline=self.start+deadline_s if deadline_s else None
+        self.skipped=[]
+
+    @property
+    def adaptive(self):
+        return self.deadline is not None
+
+    def remaining(self):
+        if self.deadline is None:
+            return float("inf")
+        return self.deadline-time.monotonic()
+
+    def allows(self,*stages):
+        return self.remaining()>=sum(stage_cost(s) for s in stages)
+
+    def skip(self,stage):
+        self.skipped.append(stage)
+
+
+def is_decisive(query,metas,cand,sim_scores):
+    if not cand:
+        return False
+    sims=sorted((sim_scores.get(d,-1.0) for d in cand),reverse=True)
+    if len(sims)>1 and sims[0]-sims[1]>=DECISIVE_SIM_MARGIN:
+        return True
+    q_terms=set(tokenize(query))
+    if not q_terms:
+        return False
+    title_terms=set(tokenize(metas[cand[0]].get("title") or ""))
+    return len(q_terms & title_terms)/len(q_terms)>=DECISIVE_TITLE_COVERAGE
+
+
+def budgeted_retrieve(q,mode,metas,indices,bm25,weights,allowed=None,extra_hint="",budget=None,warm=None):
+    """Retrieve and rerank one round, skipping expansions/rerank when the budget says so.
+
+    warm is an optional candidate pool from earlier turns of the same
+    conversation; when given, only the delta around q is fetched and the pool
+    is reranked together with it.
+
+    Adjacent chunks are collapsed before rerank; texts maps kept doc_ids to
+    their merged passage.
+
+    Returns (queries, final_ids, rrf_scores, sim_scores, decisive, texts).
+    """
+    budget=budget or Budget()
+    decisive=False
+    if warm:
+        queries=light_queries(q,mode,extra_hint)
+        cand,rrf_scores,sim_scores=rrf_search_multi(indices,bm25,queries,TOP_K_RETRIEVE,weights,allowed=allowed)
+        seen=set(cand)
+        cand=cand+[d for d in warm if d not in seen and (allowed is None or d in allowed)]
+        cand=lexical_prerank(q,metas,cand,bm25,PRE_RERANK_TOP_K)
+        decisive=budget.adaptive and is_decisive(q,metas,cand,sim_scores)
+        expand=False
+        budget.skip("expand")
+    elif budget.adaptive:
+        # Cheap probe with no LLM expansions; decide from its shape what to skip.
+        queries=light_queries(q,mode,extra_hint)
+        cand,rrf_scores,sim_scores=rrf_search_multi(indices,bm25,queries,TOP_K_RETRIEVE,weights,allowed=allowed)
+        cand=lexical_prerank(q,metas,cand,bm25,PRE_RERANK_TOP_K)
+        decisive=is_decisive(q,metas,cand,sim_scores)
+        expand=not decisive and budget.allows("expand","answer")
+        if not expand:
+            budget.skip("expand")
+    else:
+        expand=True
+    if expand:
+        queries=build_queries(q,mode,extra_hint=extra_hint)
+        cand,rrf_scores,sim_scores=rrf_search_multi(indices,bm25,queries,TOP_K_RETRIEVE,weights,allowed=allowed)
+        cand=lexical_prerank(q,metas,cand,bm25,PRE_RERANK_TOP_K)
+    cand,texts=collapse_chunks(metas,cand)
+    if budget.adaptive and (decisive or not budget.allows("rerank","answer")):
+        budget.skip("rerank")
+        return queries,cand[:TOP_K_FINAL],rrf_scores,sim_scores,decisive,texts
+    final_ids=rerank(q,metas,cand,texts=texts)
+    return queries,final_ids,rrf_scores,sim_scores,decisive,texts
 
 
 def parse_filters(q):
@@ -314,10 +473,12 @@ def rrf_search_multi(indices,bm25,queries,top_k,weights,allowed=None):
         w=weights.get(name,1.0)
         for qi in range(I.shape[0]):
             for rank,doc_id in enumerate(I[qi]):
+                # FAISS ids are numpy ints; keep plain ints so ids stay JSON-serialisable.
+                doc_id=int(doc_id)
                 if allowed is not None and doc_id not in allowed:
                     continue
                 scores[doc_id]=scores.get(doc_id,0.0)+w/(RRF_K+rank+1)
-                sim_scores[doc_id]=max(sim_scores.get(doc_id,-1.0),D[qi][rank])
+                sim_scores[doc_id]=max(sim_scores.get(doc_id,-1.0),float(D[qi][rank]))
     if bm25 is not None:
         w=weights.get("bm25",1.0)
         for q in queries:
@@ -345,6 +506,94 @@ def lexical_prerank(query,metas,cand,bm25,top_k):
     return [doc_id for doc_id,_ in scored[:top_k]]
 
 
+def merge_overlap(a,b):
+    # Neighbouring chunks share a token overlap, so b normally starts with a's
+    # tail. Without an exact overlap, None: concatenating would repeat it.
+    probe=b[:MIN_OVERLAP_CHARS]
+    if len(probe)<MIN_OVERLAP_CHARS:
+        return None
+    pos=a.find(probe,max(0,len(a)-len(b)))
+    while pos!=-1:
+        tail=a[pos:]
+        if b.startswith(tail):
+            return a+b[len(tail):]
+        pos=a.find(probe,pos+1)
+    return None
+
+
+def collapse_chunks(metas,cand,mode=None,char_budget=None):
+    """Collapse adjacent chunks of the same row_id in cand.
+
+    mode "best" keeps only the best-ranked chunk of each adjacent run; "merge"
+    also grows it into one deduplicated passage with its neighbours while it
+    fits char_budget. Neighbours that do not fit, or whose overlap cannot be
+    found, stay as separate candidates; if nothing merges, the run falls back
+    to "best".
+
+    Returns (cand, texts) where texts maps a kept doc_id to its merged text.
+    """
+    mode=mode or COLLAPSE_MODE
+    char_budget=char_budget or COLLAPSE_CHAR_BUDGET
+    if mode=="off" or not cand:
+        return cand,{}
+    rank={d:i for i,d in enumerate(cand)}
+    rows={}
+    for d in cand:
+        m=metas[d]
+        if m.get("row_id") is None or m.get("chunk_id") is None:
+            continue
+        try:
+            rows.setdefault(m["row_id"],[]).append((int(m["chunk_id"]),d))
+        except (TypeError,ValueError):
+            continue
+    dropped=set()
+    texts={}
+    for members in rows.values():
+        if len(members)<2:
+            continue
+        members.sort()
+        runs=[[members[0]]]
+        for cid,d in members[1:]:
+            if cid==runs[-1][-1][0]+1:
+                runs[-1].append((cid,d))
+            else:
+                runs.append([(cid,d)])
+        for run in runs:
+            if len(run)<2:
+                continue
+            ids=[d for _,d in run]
+            best=min(ids,key=lambda d:rank[d])
+            if mode=="best":
+                dropped.update(d for d in ids if d!=best)
+                continue
+            # Grow outward from the best chunk, nearer neighbours first.
+            pos=ids.index(best)
+            lo=hi=pos
+            text=metas[best].get("text","")
+            while True:
+                grew=False
+                if lo>0:
+                    merged=merge_overlap(metas[ids[lo-1]].get("text",""),text)
+                    if merged is not None and len(merged)<=char_budget:
+                        text=merged
+                        lo-=1
+                        grew=True
+                if hi<len(ids)-1:
+                    merged=merge_overlap(text,metas[ids[hi+1]].get("text",""))
+                    if merged is not None and len(merged)<=char_budget:
+                        text=merged
+                        hi+=1
+                        grew=True
+                if not grew:
+                    break
+            if hi==lo:
+                dropped.update(d for d in ids if d!=best)
+                continue
+            texts[best]=text
+            dropped.update(d for d in ids[lo:hi+1] if d!=best)
+    return [d for d in cand if d not in dropped],texts
+
+
 def parse_json(text):
     start=text.find("{")
     end=text.rfind("}")
@@ -377,16 +626,18 @@ def parse_json_list(text):
     return out
 
 
-def rerank(query,metas,cand):
+def rerank(query,metas,cand,texts=None):
     if not RERANK or not cand:
         return cand[:TOP_K_FINAL]
+    texts=texts or {}
     items=[]
     for idx in cand:
         m=metas[idx]
+        text=(texts.get(idx) or m.get("text",""))[:RERANK_CHAR_LIMIT]
         items.append({
             "id":int(idx),
             "title":m.get("title",""),
-            "text":m.get("text","")[:RERANK_CHAR_LIMIT],
+            "text":text,
         })
     prompt=(
         "당신은 엄격한 재랭커입니다. 질문과 문서 목록이 주어지면, 관련도 내림차순으로 "
@@ -396,10 +647,14 @@ def rerank(query,metas,cand):
         f"질문: {query}\n\n문서:\n{json.dumps(items,ensure_ascii=False)}"
     )
     ids=[]
+    # A second attempt only helps with unparseable output; slow or failed calls
+    # are already hedged by the gateway.
     for _ in range(2):
         try:
-            resp=client.responses.create(model=GEN_MODEL,input=prompt)
-            ids=parse_json_list(resp.output_text)
+            out=gateway.respond(GEN_MODEL,prompt,timeout=AUX_TIMEOUT,hedge=True,key="rerank")
+            ids=parse_json_list(out)
+        except GatewayTimeout:
+            break
         except Exception:
             ids=[]
         if ids:
@@ -411,7 +666,7 @@ def rerank(query,metas,cand):
     return out[:TOP_K_FINAL] if out else cand[:TOP_K_FINAL]
 
 
-def answer_or_request(q,ctx,allow_more=True,relax_context=False,mode="other"):
+def answer_or_request(q,ctx,allow_more=True,relax_context=False,mode="other",inline_verify=False):
     schema=(
         "JSON만 반환하세요. 하나의 action을 선택하세요:\n"
         "1) {\"action\":\"answer\",\"answer\":\"...\",\"confidence\":0-1}\n"
@@ -419,6 +674,12 @@ def answer_or_request(q,ctx,allow_more=True,relax_context=False,mode="other"):
         "3) {\"action\":\"need_config\",\"message\":\"...\"}\n"
         "4) (답변일 때만) \"evidence_found\": [\"...\"], \"evidence_missing\": [\"...\"]\n"
     )
+    if inline_verify:
+        schema+=(
+            "5) (답변일 때만) 답변의 각 주장을 스스로 검증하세요: "
+            "\"claims\": [{\"claim\":\"...\",\"citations\":[1],\"supported\":true/false}], "
+            "\"missing\": \"뒷받침되지 않는 부분에 필요한 정보 (없으면 빈 문자열)\"\n"
+        )
     guidance="" if allow_more else f"추가 검색을 요청할 수 없습니다. 답하거나 \"{NOT_FOUND_MSG}\"라고 하세요.\n"
     relax=(
         "문맥에 없는 내용은 추정임을 명확히 표시하고, "
@@ -437,8 +698,12 @@ def answer_or_request(q,ctx,allow_more=True,relax_context=False,mode="other"):
         "이 질문은 조선왕조실록에 관한 검색/질의입니다.\n"
         f"{compare}{relax}{guidance}{schema}\n문맥:\n{''.join(ctx)}\n\n질문: {q}"
     )
-    resp=client.responses.create(model=GEN_MODEL,input=prompt)
-    data=parse_json(resp.output_text)
+    try:
+        out=gateway.respond(GEN_MODEL,prompt,timeout=GEN_TIMEOUT,key="answer")
+    except (GatewayTimeout,APIError):
+        # Retries are exhausted; an empty action lets callers keep their best answer.
+        return {}
+    data=parse_json(out)
     return data
 
 
@@ -450,8 +715,8 @@ def verify_answer(q,ctx,answer):
         f"질문: {q}\n\n문맥:\n{''.join(ctx)}\n\n답변: {answer}"
     )
     try:
-        resp=client.responses.create(model=GEN_MODEL,input=prompt)
-        data=parse_json(resp.output_text)
+        out=gateway.respond(GEN_MODEL,prompt,timeout=GEN_TIMEOUT,hedge=True,key="verify")
+        data=parse_json(out)
         supported=bool(data.get("supported",False))
         missing=str(data.get("missing","")).strip()
         return supported,missing
@@ -459,6 +724,51 @@ def verify_answer(q,ctx,answer):
         return True,""
 
 
+def cited_numbers(answer,n_ctx):
+    out=[]
+    for m in CITE_RE.finditer(answer or ""):
+        n=int(m.group(1))
+        if 1<=n<=n_ctx and n not in out:
+            out.append(n)
+    return out
+
+
+def verify_cited(q,ctx,answer):
+    # ctx[n-1] is passage [n]; only the passages the answer cites are sent.
+    nums=cited_numbers(answer,len(ctx))
+    if not nums:
+        return verify_answer(q,ctx,answer)
+    return verify_answer(q,[ctx[n-1] for n in nums],answer)
+
+
+def inline_verdict(resp):
+    claims=resp.get("claims")
+    if not isinstance(claims,list) or not claims:
+        return None
+    unsupported=[]
+    for c in claims:
+        if not isinstance(c,dict):
+            continue
+        if not c.get("supported",False) or not c.get("citations"):
+            unsupported.append(str(c.get("claim","")).strip())
+    missing=str(resp.get("missing","")).strip()
+    if not unsupported:
+        return True,""
+    return False,missing or "; ".join([u for u in unsupported if u])
+
+
+def check_answer(q,ctx,answer,resp=None,mode=None):
+    mode=mode or VERIFY_MODE
+    if mode=="inline":
+        verdict=inline_verdict(resp or {})
+        if verdict is not None:
+            return verdict
+        return verify_cited(q,ctx,answer)
+    if mode=="cited":
+        return verify_cited(q,ctx,answer)
+    return verify_answer(q,ctx,answer)
+
+
 def refine_query(q,missing):
     if not missing:
         return ""
@@ -469,8 +779,8 @@ def refine_query(q,missing):
         f"원본 질문: {q}\n부족한 정보: {missing}"
     )
     try:
-        resp=client.responses.create(model=GEN_MODEL,input=prompt)
-        return resp.output_text.strip()
+        out=gateway.respond(GEN_MODEL,prompt,timeout=AUX_TIMEOUT,hedge=True,key="refine")
+        return out.strip()
     except Exception:
         return ""
 
@@ -525,15 +835,23 @@ def main():
     ap.add_argument("--hide-docs",action="store_true")
     ap.add_argument("--no-rerank",action="store_true")
     ap.add_argument("--relax-context",action="store_true")
+    ap.add_argument("--verify-mode",choices=VERIFY_MODES,default=None)
+    ap.add_argument("--deadline",type=float,default=None,help="per-query latency budget in seconds")
+    ap.add_argument("--collapse",choices=COLLAPSE_MODES,default=None)
     args=ap.parse_args()
 
-    global RERANK, RELAX_CONTEXT
+    global RERANK, RELAX_CONTEXT, VERIFY_MODE, COLLAPSE_MODE
+    if args.collapse:
+        COLLAPSE_MODE=args.collapse
+    if args.verify_mode:
+        VERIFY_MODE=args.verify_mode
     if args.no_rerank:
         RERANK=False
     if args.relax_context:
         RELAX_CONTEXT=True
 
     index,index_sum,index_title,metas,bm25,bm25_title=load_store(args.store_dir)
+    load_classifier(args.store_dir)
     indices={"full":index,"sum":index_sum,"title":index_title}
 
     while True:
@@ -548,87 +866,103 @@ def main():
         final_answer=""
         final_ctx=[]
         action=""
+        mode,mode_source="other","default"
         last_queries=[]
         final_ids=[]
-        for _ in range(MAX_ROUNDS):
-            q=user_q
-            if refined_q:
-                q=f"{user_q}\nFocus: {refined_q}"
-            mode=classify_query(user_q)
-            queries=build_queries(user_q,mode,extra_hint=refined_q)
-            last_queries=queries[:]
-            if meta_only:
-                weights={"title":1.0,"bm25":1.0}
-                use_indices={"title":index_title}
-                use_bm25=bm25_title
-            else:
-                weights=route_weights(mode)
-                use_indices=indices
-                use_bm25=bm25
-            cand,rrf_scores,sim_scores=rrf_search_multi(use_indices,use_bm25,queries,TOP_K_RETRIEVE,weights,allowed=allowed)
-            cand=lexical_prerank(user_q,metas,cand,use_bm25,PRE_RERANK_TOP_K)
-            final_ids=rerank(user_q,metas,cand)
-            ctx=[]
-            retrieved=[]
-            for i,idx in enumerate(final_ids):
-                m=metas[idx]
-                retrieved.append((i,idx,m,rrf_scores.get(idx,0.0),sim_scores.get(idx,0.0)))
-                title=m.get("title","")
-                link=m.get("link","")
-                meta_line=format_meta(m)
-                meta_line=f"\nMETA: {meta_line}" if meta_line else ""
-                ctx.append(f"[{i+1}] {title}\nLINK: {link}{meta_line}\n{m['text'][:DOC_CHAR_LIMIT]}")
-            show_docs = not args.hide_docs if SHOW_DOCS else False
-            if show_docs:
-                print("\n--- Retrieved docs ---")
-                for rank,idx,m,rrf,sim in retrieved:
-                    title=m.get("title","").strip() or "(no title)"
-                    link=m.get("link","").strip()
-                    text=m.get("text","")[:DOC_CHAR_LIMIT]
-                    meta=(
-                        f"doc_id={idx} row_id={m.get('row_id')} "
-                        f"chunk_id={m.get('chunk_id')} rrf={rrf:.4f} sim={sim:.4f}"
+        budget=Budget(args.deadline)
+        # Bound in-flight upstream calls by the query deadline, not just stage planning.
+        with request_scope(deadline=budget.deadline):
+            for _ in range(MAX_ROUNDS):
+                if final_ctx and not budget.allows("answer"):
+                    break
+                q=user_q
+                if refined_q:
+                    q=f"{user_q}\nFocus: {refined_q}"
+                mode,mode_source=classify_query_source(user_q)
+                if meta_only:
+                    weights={"title":1.0,"bm25":1.0}
+                    use_indices={"title":index_title}
+                    use_bm25=bm25_title
+                else:
+                    weights=route_weights(mode)
+                    use_indices=indices
+                    use_bm25=bm25
+                try:
+                    queries,final_ids,rrf_scores,sim_scores,decisive,texts=budgeted_retrieve(
+                        user_q,mode,metas,use_indices,use_bm25,weights,
+                        allowed=allowed,extra_hint=refined_q,budget=budget,
                     )
+                except GatewayTimeout:
+                    break
+                last_queries=queries[:]
+                ctx=[]
+                retrieved=[]
+                for i,idx in enumerate(final_ids):
+                    m=metas[idx]
+                    retrieved.append((i,idx,m,rrf_scores.get(idx,0.0),sim_scores.get(idx,0.0)))
+                    title=m.get("title","")
+                    link=m.get("link","")
                     meta_line=format_meta(m)
-                    if meta_line:
-                        meta+=f" meta=({meta_line})"
-                    print(f"\n[{rank+1}] {title}\n{meta}")
-                    if link:
-                        print(f"link: {link}")
-                    print(text)
-                print("\n--- End docs ---\n")
-            resp=answer_or_request(
-                raw_q,
-                ctx,
-                allow_more=(_<MAX_ROUNDS-1),
-                relax_context=RELAX_CONTEXT,
-                mode=mode,
-            )
-            action=resp.get("action","")
-            if action=="search_more":
-                refined_q=resp.get("query","").strip()
-                if not refined_q:
-                    refined_q=refine_query(user_q,"more specific evidence")
-                continue
-            if action=="need_config":
-                msg=resp.get("message","").strip() or "Configuration change needed."
-                print(msg)
-                log_event(args.store_dir,{"query":raw_q,"action":"need_config","message":msg})
-                break
-            if action!="answer":
-                # fallback to standard answer step
-                answer=resp.get("answer","") or NOT_FOUND_MSG
-            else:
-                answer=resp.get("answer","")
-            evidence_block=build_evidence_block(resp)
-            final_answer=answer + evidence_block if evidence_block and evidence_block not in answer else answer
-            final_ctx=ctx
-            if RELAX_CONTEXT:
-                break
-            supported,missing=verify_answer(raw_q,ctx,answer)
-            if supported:
-                break
-            refined_q=refine_query(user_q,missing)
+                    meta_line=f"\nMETA: {meta_line}" if meta_line else ""
+                    text=(texts.get(idx) or m["text"])[:DOC_CHAR_LIMIT]
+                    ctx.append(f"[{i+1}] {title}\nLINK: {link}{meta_line}\n{text}")
+                show_docs = not args.hide_docs if SHOW_DOCS else False
+                if show_docs:
+                    print("\n--- Retrieved docs ---")
+                    for rank,idx,m,rrf,sim in retrieved:
+                        title=m.get("title","").strip() or "(no title)"
+                        link=m.get("link","").strip()
+                        text=(texts.get(idx) or m.get("text",""))[:DOC_CHAR_LIMIT]
+                        meta=(
+                            f"doc_id={idx} row_id={m.get('row_id')} "
+                            f"chunk_id={m.get('chunk_id')} rrf={rrf:.4f} sim={sim:.4f}"
+                        )
+                        meta_line=format_meta(m)
+                        if meta_line:
+                            meta+=f" meta=({meta_line})"
+                        print(f"\n[{rank+1}] {title}\n{meta}")
+                        if link:
+                            print(f"link: {link}")
+                        print(text)
+                    print("\n--- End docs ---\n")
+                resp=answer_or_request(
+                    raw_q,
+                    ctx,
+                    allow_more=(_<MAX_ROUNDS-1 and budget.allows("expand","answer","answer")),
+                    relax_context=RELAX_CONTEXT,
+                    mode=mode,
+                    inline_verify=(VERIFY_MODE=="inline"),
+                )
+                if not resp and final_answer:
+                    break
+                action=resp.get("action","")
+                if action=="search_more":
+                    refined_q=resp.get("query","").strip()
+                    if not refined_q:
+                        refined_q=refine_query(user_q,"more specific evidence")
+                    continue
+                if action=="need_config":
+                    msg=resp.get("message","").strip() or "Configuration change needed."
+                    print(msg)
+                    log_event(args.store_dir,{"query":raw_q,"action":"need_config","message":msg})
+                    break
+                if action!="answer":
+                    # fallback to standard answer step
+                    answer=resp.get("answer","") or NOT_FOUND_MSG
+                else:
+                    answer=resp.get("answer","")
+                evidence_block=build_evidence_block(resp)
+                final_answer=answer + evidence_block if evidence_block and evidence_block not in answer else answer
+                final_ctx=ctx
+                if RELAX_CONTEXT:
+                    break
+                if budget.adaptive and (decisive or not budget.allows("verify","answer")):
+                    budget.skip("verify")
+                    break
+                supported,missing=check_answer(raw_q,ctx,answer,resp=resp)
+                if supported:
+                    break
+                refined_q=refine_query(user_q,missing)
         if not final_ctx:
             print(NOT_FOUND_MSG)
             log_event(args.store_dir,{"query":raw_q,"action":"no_context","meta_only":meta_only})
@@ -639,14 +973,17 @@ def main():
                 print(final_answer)
             log_event(args.store_dir,{
                 "query":raw_q,
+                "clean_query":user_q,
                 "filters":filters,
                 "meta_only":meta_only,
                 "mode":mode,
+                "mode_source":mode_source,
                 "queries":last_queries,
                 "final_ids":final_ids,
                 "action":action or "answer",
                 "answer":final_answer,
                 "ctx_count":len(final_ctx),
+                "skipped":budget.skipped,
             })
 
 
@@ -0,0 +1,90 @@
+"""
+Bounded, TTL-evicted retrieval state per conversation.
+
+Follow-up turns in a chat reuse the previous turns' candidate pool instead of
+retrieving from zero. Sessions are evicted LRU-first once either the session
+count or the approximate memory cap is exceeded.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+# Rough per-entry overhead for ids and score dict slots.
+_ID_BYTES = 96
+
+
+class RetrievalSession:
+    def __init__(self, doc_ids, rrf_scores, sim_scores, query_vec):
+        self.doc_ids = list(doc_ids)
+        self.rrf_scores = dict(rrf_scores)
+        self.sim_scores = dict(sim_scores)
+        self.query_vec = np.asarray(query_vec, dtype=np.float32)
+        self.updated = time.monotonic()
+
+    def nbytes(self):
+        return self.query_vec.nbytes + _ID_BYTES * (
+            len(self.doc_ids) + len(self.rrf_scores) + len(self.sim_scores)
+        )
+
+    def similarity(self, query_vec):
+        # Both vectors come from embed_many, which L2-normalises them.
+        return float(np.dot(self.query_vec, np.asarray(query_vec, dtype=np.float32)))
+
+
+class SessionStore:
+    def __init__(self, max_sessions, max_bytes, ttl_s):
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.ttl_s = ttl_s
+        self._sessions = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    @property
+    def nbytes(self):
+        return self._bytes
+
+    def get(self, key):
+        if not key:
+            return None
+        with self._lock:
+            self._expire(time.monotonic())
+            session = self._sessions.get(key)
+            if session is not None:
+                # TTL counts idle time, which keeps LRU order and expiry order aligned.
+                session.updated = time.monotonic()
+                self._sessions.move_to_end(key)
+            return session
+
+    def put(self, key, session):
+        if not key:
+            return
+        with self._lock:
+            self._drop(key)
+            session.updated = time.monotonic()
+            self._sessions[key] = session
+            self._bytes += session.nbytes()
+            self._expire(session.updated)
+            while self._sessions and (
+                len(self._sessions) > self.max_sessions or self._bytes > self.max_bytes
+            ):
+                self._drop(next(iter(self._sessions)))
+
+    def _drop(self, key):
+        session = self._sessions.pop(key, None)
+        if session is not None:
+            self._bytes -= session.nbytes()
+
+    def _expire(self, now):
+        # Entries are in LRU order, so the stalest sit at the front.
+        while self._sessions:
+            key, session = next(iter(self._sessions.items()))
+            if now - session.updated <= self.ttl_s:
+                break
+            self._drop(key)
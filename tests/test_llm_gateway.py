@@ -0,0 +1,199 @@
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from llm_gateway import Cancelled, Gateway, GatewayTimeout, request_scope  # noqa: E402
+
+
+def _response_body(text):
+    return {
+        "id": "resp",
+        "object": "response",
+        "created_at": 0,
+        "model": "fake",
+        "status": "completed",
+        "output": [
+            {
+                "type": "message",
+                "id": "msg",
+                "role": "assistant",
+                "status": "completed",
+                "content": [{"type": "output_text", "text": text, "annotations": []}],
+            }
+        ],
+        "parallel_tool_calls": False,
+        "tool_choice": "auto",
+        "tools": [],
+    }
+
+
+class FakeServer:
+    """Local stand-in for the Responses API; each request pops one scripted step."""
+
+    def __init__(self):
+        self.script = []
+        self.hits = []
+        self.lock = threading.Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers["Content-Length"]))
+                with fake.lock:
+                    fake.hits.append(time.monotonic())
+                    step = fake.script.pop(0) if fake.script else {}
+                time.sleep(step.get("delay", 0.0))
+                status = step.get("status", 200)
+                if status == 200:
+                    body = _response_body(step.get("text", "ok"))
+                else:
+                    body = {"error": {"message": "fake error", "type": "fake"}}
+                data = json.dumps(body).encode()
+                try:
+                    self.send_response(status)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(data)))
+                    for k, v in step.get("headers", {}).items():
+                        self.send_header(k, v)
+                    self.end_headers()
+                    self.wfile.write(data)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.base_url = f"http://127.0.0.1:{self.httpd.server_port}/v1"
+
+    def close(self):
+        self.httpd.shutdown()
+
+
+@pytest.fixture
+def server():
+    s = FakeServer()
+    yield s
+    s.close()
+
+
+def _gateway(server, **kwargs):
+    kwargs.setdefault("hedge_delay", 0.05)
+    return Gateway(base_url=server.base_url, api_key="test", **kwargs)
+
+
+def test_respond_returns_output_text(server):
+    server.script = [{"text": "hello"}]
+    assert _gateway(server).respond("fake", "q") == "hello"
+
+
+def test_deadline_raises_gateway_timeout(server):
+    server.script = [{"delay": 1.0}]
+    g = _gateway(server)
+    t0 = time.monotonic()
+    with pytest.raises(GatewayTimeout):
+        g.respond("fake", "q", timeout=0.2)
+    assert time.monotonic() - t0 < 0.8
+
+
+def test_request_scope_caps_call_timeout(server):
+    server.script = [{"delay": 1.0}]
+    g = _gateway(server)
+    with request_scope(deadline=time.monotonic() + 0.2):
+        with pytest.raises(GatewayTimeout):
+            g.respond("fake", "q", timeout=30)
+
+
+def test_hedge_wins_once_latency_is_known(server):
+    g = _gateway(server)
+    for _ in range(12):
+        g.respond("fake", "warm", hedge=True, key="aux")
+    server.script = [{"delay": 2.0, "text": "slow"}, {"text": "fast"}]
+    t0 = time.monotonic()
+    assert g.respond("fake", "q", hedge=True, key="aux") == "fast"
+    assert time.monotonic() - t0 < 1.0
+    assert g.stats["hedge_wins"] == 1
+
+
+def test_no_hedge_before_latency_is_known(server):
+    g = _gateway(server)
+    server.script = [{"delay": 0.3, "text": "only"}]
+    assert g.respond("fake", "q", hedge=True, key="cold") == "only"
+    assert g.stats["hedges"] == 0
+
+
+def test_retries_transient_server_error(server):
+    server.script = [{"status": 500}, {"text": "recovered"}]
+    g = _gateway(server)
+    assert g.respond("fake", "q") == "recovered"
+    assert g.stats["retries"] == 1
+
+
+def test_rate_limit_headers_pause_bucket_before_retry(server):
+    server.script = [
+        {
+            "status": 429,
+            "headers": {
+                "retry-after": "0.6",
+                "x-ratelimit-remaining-requests": "0",
+                "x-ratelimit-reset-requests": "600ms",
+            },
+        },
+        {"text": "after pause"},
+    ]
+    g = _gateway(server)
+    assert g.respond("fake", "q") == "after pause"
+    assert len(server.hits) == 2
+    assert server.hits[1] - server.hits[0] >= 0.55
+
+
+def test_rate_limit_wait_beyond_deadline_times_out(server):
+    server.script = [
+        {"status": 429, "headers": {"retry-after": "20"}},
+        {"text": "never"},
+    ]
+    g = _gateway(server)
+    with pytest.raises(GatewayTimeout):
+        g.respond("fake", "q", timeout=1.0)
+    assert g.bucket.blocked_until > time.monotonic() + 15
+    assert len(server.hits) == 1
+
+
+def _wait_idle(g, timeout=0.3):
+    end = time.monotonic() + timeout
+    while g.in_flight and time.monotonic() < end:
+        time.sleep(0.01)
+    return g.in_flight
+
+
+def test_cancel_aborts_upstream_attempt(server):
+    server.script = [{"delay": 1.5}, {"text": "next"}]
+    g = _gateway(server, max_concurrency=1)
+    cancel = threading.Event()
+    threading.Timer(0.1, cancel.set).start()
+    with request_scope(cancel=cancel):
+        with pytest.raises(Cancelled):
+            g.respond("fake", "q")
+    # The attempt itself ends (its connection is closed), not just its slot.
+    assert _wait_idle(g) == 0
+    assert g.respond("fake", "q2", timeout=1.0) == "next"
+
+
+def test_losing_hedge_attempt_is_aborted(server):
+    g = _gateway(server)
+    for _ in range(12):
+        g.respond("fake", "warm", hedge=True, key="aux")
+    server.script = [{"delay": 2.0, "text": "slow"}, {"text": "fast"}]
+    assert g.respond("fake", "q", hedge=True, key="aux") == "fast"
+    assert _wait_idle(g) == 0
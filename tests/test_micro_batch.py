@@ -0,0 +1,100 @@
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from llm_gateway import GatewayTimeout, request_scope  # noqa: E402
+from micro_batch import BatchedIndex, MicroBatcher  # noqa: E402
+
+
+def _slow_echo(delay):
+    calls = []
+
+    def fn(items):
+        calls.append(list(items))
+        time.sleep(delay)
+        return [x * 10 for x in items]
+
+    return fn, calls
+
+
+def _concurrent(batcher, n):
+    latencies = [None] * n
+    results = [None] * n
+
+    def worker(i):
+        t0 = time.monotonic()
+        results[i] = batcher.submit(i)
+        latencies[i] = time.monotonic() - t0
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results, latencies
+
+
+def test_submit_returns_result_for_its_own_item():
+    fn, _ = _slow_echo(0.0)
+    batcher = MicroBatcher(fn, size=lambda _: 1)
+    assert batcher.submit(3) == 30
+
+
+def test_batches_run_concurrently_up_to_max_in_flight():
+    fn, calls = _slow_echo(0.3)
+    batcher = MicroBatcher(fn, window_ms=20, max_batch=2, size=lambda _: 1, max_in_flight=4)
+    results, latencies = _concurrent(batcher, 6)
+    assert results == [i * 10 for i in range(6)]
+    # Three batches of two overlap instead of queuing behind one another.
+    assert max(latencies) < 0.55
+    assert all(len(c) <= 2 for c in calls)
+
+
+def test_max_in_flight_bounds_parallel_batches():
+    fn, _ = _slow_echo(0.2)
+    batcher = MicroBatcher(fn, window_ms=20, max_batch=1, size=lambda _: 1, max_in_flight=1)
+    _, latencies = _concurrent(batcher, 3)
+    assert max(latencies) >= 0.55
+
+
+def test_batch_error_reaches_every_caller():
+    def fn(items):
+        raise ValueError("boom")
+
+    batcher = MicroBatcher(fn, size=lambda _: 1)
+    with pytest.raises(ValueError):
+        batcher.submit(1)
+    # The slot is handed back after a failure.
+    with pytest.raises(ValueError):
+        batcher.submit(2)
+
+
+def test_submit_honours_scope_deadline():
+    fn, _ = _slow_echo(1.0)
+    batcher = MicroBatcher(fn, size=lambda _: 1)
+    with request_scope(deadline=time.monotonic() + 0.1):
+        with pytest.raises(GatewayTimeout):
+            batcher.submit(1)
+
+
+class _FakeIndex:
+    ntotal = 4
+
+    def search(self, x, k):
+        D = np.tile(np.arange(k, dtype=np.float32), (x.shape[0], 1))
+        I = np.tile(np.arange(k, dtype=np.int64), (x.shape[0], 1)) + x[:, :1].astype(np.int64)
+        return D, I
+
+
+def test_batched_index_splits_rows_and_k_per_caller():
+    index = BatchedIndex(_FakeIndex())
+    assert index.ntotal == 4
+    D, I = index.search(np.array([[5.0, 0.0]]), 2)
+    assert D.shape == (1, 2)
+    assert I.tolist() == [[5, 6]]
@@ -0,0 +1,64 @@
+import json
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from query_classifier import LABELS, QueryClassifier, load_examples  # noqa: E402
+
+
+def _onehot(i, dim=len(LABELS)):
+    v = np.zeros(dim, dtype=np.float32)
+    v[i] = 1.0
+    return v
+
+
+def _write_jsonl(path, rows):
+    with open(path, "w", encoding="utf-8") as f:
+        for row in rows:
+            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+
+def test_fit_and_predict_nearest_centroid():
+    vecs = [_onehot(i) for i in range(len(LABELS)) for _ in range(3)]
+    labels = [l for l in LABELS for _ in range(3)]
+    clf = QueryClassifier.fit(vecs, labels)
+    assert clf.counts.tolist() == [3] * len(LABELS)
+    label, conf = clf.predict(_onehot(LABELS.index("list")))
+    assert label == "list"
+    assert conf > 0.9
+
+
+def test_predict_reports_zero_confidence_when_a_label_is_untrained():
+    clf = QueryClassifier.fit([_onehot(0), _onehot(0)], ["other", "other"])
+    assert clf.predict(_onehot(0), "세종과 세조 비교") == ("other", 0.0)
+
+
+def test_save_load_round_trip(tmp_path):
+    vecs = [_onehot(i) for i in range(len(LABELS))]
+    clf = QueryClassifier.fit(vecs, list(LABELS))
+    path = str(tmp_path / "clf.npz")
+    clf.save(path)
+    loaded = QueryClassifier.load(path)
+    assert np.allclose(loaded.centroids, clf.centroids)
+    assert loaded.counts.tolist() == clf.counts.tolist()
+
+
+def test_load_examples_trusts_only_llm_log_rows_and_hand_labels(tmp_path):
+    os.makedirs(tmp_path / "logs")
+    _write_jsonl(
+        tmp_path / "logs" / "query_log.jsonl",
+        [
+            {"query": "title:x ~a", "clean_query": "a", "mode": "list", "mode_source": "llm"},
+            {"query": "no clean text", "mode": "list", "mode_source": "llm"},
+            {"query": "b", "mode": "list", "mode_source": "local"},
+            {"query": "c", "mode": "list"},
+            {"query": "d", "mode": "other", "mode_source": "default"},
+            {"query": "e", "mode": "unknown-label", "mode_source": "llm"},
+        ],
+    )
+    labels = tmp_path / "labels.jsonl"
+    _write_jsonl(labels, [{"query": "b", "label": "comparison"}])
+    assert load_examples(str(tmp_path), str(labels)) == {"a": "list", "b": "comparison"}
@@ -0,0 +1,98 @@
+import json
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+import rag_query  # noqa: E402
+
+
+class _FakeIndex:
+    def search(self, x, k):
+        D = np.full((x.shape[0], k), 0.5, dtype=np.float32)
+        I = np.tile(np.arange(k, dtype=np.int64), (x.shape[0], 1))
+        return D, I
+
+
+def test_rrf_search_multi_returns_plain_int_ids(monkeypatch):
+    monkeypatch.setattr(rag_query, "embed_many", lambda qs: np.ones((len(qs), 2), dtype=np.float32))
+    cand, scores, sims = rag_query.rrf_search_multi({"full": _FakeIndex()}, None, ["q"], 3, {})
+    assert all(type(d) is int for d in cand)
+    json.dumps({"final_ids": cand, "sims": list(sims.values())})
+
+
+def test_stage_cost_uses_defaults_until_gateway_has_samples(monkeypatch):
+    monkeypatch.setattr(rag_query.gateway, "latency", {})
+    assert rag_query.stage_cost("answer") == rag_query.STAGE_COST["answer"]
+    for _ in range(20):
+        rag_query.gateway._record("answer", 0.5)
+    assert rag_query.stage_cost("answer") == 0.5
+
+
+def test_budget_without_deadline_allows_everything():
+    assert rag_query.Budget().allows("expand", "rerank", "answer", "verify")
+    assert not rag_query.Budget(0.01).allows("answer")
+
+
+def test_light_queries_dedupes_and_caps():
+    queries = rag_query.light_queries("조선왕조실록 비교", "comparison", extra_hint="조선왕조실록 비교")
+    assert queries[0] == "조선왕조실록 비교"
+    assert len({q.lower() for q in queries}) == len(queries)
+    assert len(queries) <= rag_query.MAX_QUERY_EXPANSIONS
+
+
+# Deterministic non-repeating text so overlaps are unambiguous.
+_TEXT = "".join(chr(0xAC00 + (i * 7919) % 11172) for i in range(1000))
+
+
+def _chunks(starts, size=200, row_id=1):
+    return [
+        {"row_id": row_id, "chunk_id": cid, "text": _TEXT[start : start + size]}
+        for cid, start in starts
+    ]
+
+
+def test_merge_overlap_joins_on_shared_tail():
+    a, b = _TEXT[0:200], _TEXT[150:350]
+    assert rag_query.merge_overlap(a, b) == _TEXT[0:350]
+
+
+def test_merge_overlap_returns_none_without_exact_overlap():
+    a, b = _TEXT[0:200], " " + _TEXT[150:350]
+    assert rag_query.merge_overlap(a, b) is None
+    assert rag_query.merge_overlap(_TEXT[0:200], _TEXT[500:700]) is None
+    assert rag_query.merge_overlap(_TEXT[0:200], _TEXT[180:200]) is None
+
+
+def test_collapse_merge_grows_best_chunk_into_one_passage():
+    metas = _chunks([(0, 0), (1, 150), (2, 300)])
+    cand, texts = rag_query.collapse_chunks(metas, [1, 0, 2], mode="merge", char_budget=1000)
+    assert cand == [1]
+    assert texts == {1: _TEXT[0:500]}
+
+
+def test_collapse_best_keeps_only_top_ranked_chunk():
+    metas = _chunks([(0, 0), (1, 150), (2, 300)])
+    assert rag_query.collapse_chunks(metas, [2, 0, 1], mode="best") == ([2], {})
+
+
+def test_collapse_leaves_chunk_id_gaps_alone():
+    metas = _chunks([(0, 0), (2, 300)])
+    assert rag_query.collapse_chunks(metas, [0, 1], mode="merge", char_budget=1000) == ([0, 1], {})
+
+
+def test_collapse_keeps_neighbour_that_does_not_fit():
+    metas = _chunks([(0, 0), (1, 150), (2, 300)])
+    cand, texts = rag_query.collapse_chunks(metas, [1, 2, 0], mode="merge", char_budget=360)
+    assert cand == [1, 2]
+    assert texts == {1: _TEXT[0:350]}
+
+
+def test_collapse_falls_back_to_best_when_nothing_merges():
+    metas = _chunks([(0, 0), (1, 150)])
+    assert rag_query.collapse_chunks(metas, [1, 0], mode="merge", char_budget=250) == ([1], {})
+    metas[0]["text"] = _TEXT[600:800]
+    assert rag_query.collapse_chunks(metas, [1, 0], mode="merge", char_budget=1000) == ([1], {})
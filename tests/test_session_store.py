@@ -0,0 +1,90 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import session_store  # noqa: E402
+from session_store import RetrievalSession, SessionStore  # noqa: E402
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def _session(n_ids=2, dim=4):
+    ids = list(range(n_ids))
+    vec = np.ones(dim, dtype=np.float32) / np.sqrt(dim)
+    return RetrievalSession(ids, {d: 0.1 for d in ids}, {d: 0.5 for d in ids}, vec)
+
+
+def _store(monkeypatch, max_sessions=10, max_bytes=1 << 20, ttl_s=60.0):
+    clock = _Clock()
+    monkeypatch.setattr(session_store.time, "monotonic", clock)
+    return SessionStore(max_sessions, max_bytes, ttl_s), clock
+
+
+def test_get_returns_stored_session_and_ignores_empty_key(monkeypatch):
+    store, _ = _store(monkeypatch)
+    s = _session()
+    store.put("c1", s)
+    store.put("", _session())
+    assert store.get("c1") is s
+    assert store.get("") is None
+    assert len(store) == 1
+
+
+def test_ttl_expires_idle_sessions(monkeypatch):
+    store, clock = _store(monkeypatch, ttl_s=60.0)
+    store.put("old", _session())
+    clock.now += 30
+    store.put("new", _session())
+    clock.now += 31
+    assert store.get("old") is None
+    assert store.get("new") is not None
+    assert len(store) == 1
+
+
+def test_get_refreshes_ttl(monkeypatch):
+    store, clock = _store(monkeypatch, ttl_s=60.0)
+    store.put("c1", _session())
+    clock.now += 50
+    assert store.get("c1") is not None
+    clock.now += 50
+    assert store.get("c1") is not None
+
+
+def test_lru_eviction_on_session_count(monkeypatch):
+    store, _ = _store(monkeypatch, max_sessions=2)
+    store.put("a", _session())
+    store.put("b", _session())
+    store.get("a")
+    store.put("c", _session())
+    assert store.get("b") is None
+    assert store.get("a") is not None
+    assert store.get("c") is not None
+
+
+def test_byte_cap_evicts_and_tracks_bytes(monkeypatch):
+    one = _session().nbytes()
+    store, _ = _store(monkeypatch, max_bytes=2 * one)
+    store.put("a", _session())
+    store.put("b", _session())
+    assert store.nbytes == 2 * one
+    store.put("c", _session())
+    assert store.get("a") is None
+    assert len(store) == 2
+    assert store.nbytes == 2 * one
+    # Replacing a key swaps its bytes rather than adding to them.
+    store.put("c", _session())
+    assert store.nbytes == 2 * one
+
+
+def test_similarity_is_dot_product_of_normalised_vectors():
+    s = _session()
+    assert abs(s.similarity(s.query_vec) - 1.0) < 1e-6